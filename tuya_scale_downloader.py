@@ -1,14 +1,29 @@
 import logging
 import json
-from datetime import datetime, timedelta
-import pytz
+import heapq
+import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from operator import itemgetter
 import os
+import threading
+import time
 
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson is optional: it speeds up reading/writing large data files, with stdlib json as fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # NB Custom tuya_connector module required for correct behaviour on POST requests with parameters
 # https://github.com/jsinkers/tuya-connector-python
 from tuya_connector import TuyaOpenAPI, TUYA_LOGGER
+from tuya_connector.openapi import TuyaTokenInfo
 
 load_dotenv()
 
@@ -20,33 +35,144 @@ DEVICE_ID = os.environ.get('DEVICE_ID')
 BIRTHDATE = os.environ.get('BIRTHDATE')
 DATA_FILE = os.environ.get('DATA_FILE')
 DEBUG_LOGS = os.environ.get('DEBUG_LOGS', False)
+TOKEN_CACHE_FILE = os.environ.get('TOKEN_CACHE_FILE', '.tuya_token.json')
+
+# number of history records requested per page, falling back to 100 if unset or invalid
+try:
+    PAGE_SIZE = int(os.environ.get('PAGE_SIZE') or 100)
+except ValueError:
+    PAGE_SIZE = 100
+if PAGE_SIZE <= 0:
+    PAGE_SIZE = 100
+
+# parse the birth date once rather than for every record
+BIRTH_DATE = datetime.strptime(BIRTHDATE, "%Y-%m-%d").date() if BIRTHDATE else None
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 # Initialize Tuya API connection
 openapi = TuyaOpenAPI(API_ENDPOINT, ACCESS_ID, ACCESS_KEY)
-openapi.connect()
+
+# Maximum number of history pages fetched concurrently, kept low to stay within Tuya rate limits
+HISTORY_WORKERS = 4
+# Maximum number of analysis reports requested concurrently
+ANALYSIS_WORKERS = 8
+
+# TuyaOpenAPI sends all requests through one requests.Session; keep enough pooled
+# keep-alive connections for every concurrent worker so none are discarded and re-opened.
+# Rate limiting and transient server errors are retried with exponential backoff; both
+# endpoints used here are safe to repeat, including the analysis report POST.
+retry = Retry(total=5, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+              allowed_methods=frozenset(['GET', 'POST']), respect_retry_after_header=True, raise_on_status=False)
+openapi.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max(HISTORY_WORKERS, ANALYSIS_WORKERS),
+                                              max_retries=retry))
+
+# Tuya error code returned when the access token is invalid, e.g. a cached token that was revoked
+TOKEN_INVALID_CODE = 1010
+token_lock = threading.Lock()
 
 # Enable debug log
 if DEBUG_LOGS:
     TUYA_LOGGER.setLevel(logging.DEBUG)
 
 
-# get a single page of scale history data
-def get_scale_data_history(device_id, page_no=1, page_size=10, start_time=None):
-    print(f"Retrieving page {page_no} of scale data history")
+# write to a temporary file and atomically move it into place, so an interrupted write never
+# leaves a truncated file behind; mode sets the permissions of a newly created file
+def atomic_write(file_path, data_bytes, mode=0o666):
+    tmp_path = file_path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data_bytes)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+# Tuya access tokens are valid for ~2 hours, so cache the token response between runs
+def load_cached_token(file_path):
+    try:
+        with open(file_path, 'r') as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if cache.get('access_id') != ACCESS_ID:
+        return None
+    token_info = TuyaTokenInfo(cache.get('token_response', {}))
+    # only reuse tokens with well over one run's length left: tuya_connector refreshes tokens within
+    # a minute of expiry without locking, which the concurrent workers below must never reach mid-run
+    if token_info.expire_time - 10 * 60 * 1000 <= time.time() * 1000:
+        return None
+    return token_info
+
+def save_cached_token(file_path, token_response):
+    # the cache holds the access and refresh tokens, so keep it readable only by the owner
+    atomic_write(file_path, json.dumps({'access_id': ACCESS_ID, 'token_response': token_response}).encode('utf-8'), 0o600)
+
+def remove_cached_token(file_path):
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+# connect to the Tuya API, reusing a cached access token if it is still valid
+def connect(use_cache=True):
+    token_info = load_cached_token(TOKEN_CACHE_FILE) if use_cache else None
+    if token_info:
+        print(f"Using cached access token from {TOKEN_CACHE_FILE}")
+        openapi.token_info = token_info
+        return
+    response = openapi.connect()
+    if response.get('success'):
+        save_cached_token(TOKEN_CACHE_FILE, response)
+    else:
+        logging.error(f"Failed to connect to Tuya API: {response}")
+
+# tuya_connector returns None for non-2xx responses (e.g. once retries are exhausted),
+# report those as an unsuccessful response so callers log the failure and carry on
+def send_request(method, *args, **kwargs):
+    return method(*args, **kwargs) or {'success': False, 'msg': 'No response from Tuya API'}
+
+# call an openapi method, reconnecting and retrying once if the access token has been rejected
+def call_api(method, *args, **kwargs):
+    response = send_request(method, *args, **kwargs)
+    if response.get('code') == TOKEN_INVALID_CODE:
+        with token_lock:
+            # tuya_connector reconnects by itself on a rejected token, without handing us the token
+            # response to cache, so drop the cached token for the next run to fetch a new one
+            remove_cached_token(TOKEN_CACHE_FILE)
+            # only reconnect here if tuya_connector's own reconnect failed
+            if not openapi.token_info:
+                print("Access token rejected, requesting a new one")
+                connect(use_cache=False)
+        response = send_request(method, *args, **kwargs)
+    return response
+
+# helper to convert a start time (ISO 8601 string or datetime, UTC) to milliseconds since Unix epoch
+def to_timestamp_ms(start_time):
+    if isinstance(start_time, str):
+        start_time = datetime.fromisoformat(start_time).replace(tzinfo=timezone.utc)
+    elif isinstance(start_time, datetime):
+        start_time = start_time.replace(tzinfo=timezone.utc)
+    # integer arithmetic avoids float rounding of the millisecond timestamp
+    return (start_time - EPOCH) // timedelta(milliseconds=1)
+
+# get a single page of scale history data, optionally starting from a time in ms since Unix epoch
+def get_scale_data_history(device_id, page_no=1, page_size=10, start_time_ms=None):
     params = {
         "page_no": page_no,
         "page_size": page_size
     }
     
-    if start_time:
-        if isinstance(start_time, str):
-            start_time = datetime.fromisoformat(start_time).replace(tzinfo=pytz.UTC)
-        elif isinstance(start_time, datetime):
-            start_time = start_time.replace(tzinfo=pytz.UTC)
-        start_time_ms = int(start_time.timestamp() * 1000)
+    if start_time_ms is not None:
         params["start_time"] = start_time_ms
 
-    response = openapi.get(f"/v1.0/scales/{device_id}/datas/history", params=params)
+    response = call_api(openapi.get, f"/v1.0/scales/{device_id}/datas/history", params=params)
     if response.get('success'):
         return response['result']
     else:
@@ -58,43 +184,94 @@ def get_all_scale_data_history(device_id, page_size=10, start_time=None):
     """ 
     @param device_id: The device ID
     @param page_size: The number of records to retrieve per page
-    @param start_time: The start time of the records to retrieve, as a string in ISO 8601 format
+    @param start_time: The start time of the records to retrieve, as a string in ISO 8601 format or a datetime
+    @return: The records, or None if any page could not be retrieved
     """
-    all_data = []
-    page_no = 1
-    total_records_retrieved = 0
-    total_records = 1 # Initialize to ensure the loop runs at least once
-
-    while total_records_retrieved < total_records:
-        result = get_scale_data_history(device_id, page_no, page_size, start_time)
-        if result:
-            num_records = len(result['records'])
-            total_records_retrieved += num_records
-            print(f"Retrieved {num_records} new records from page {page_no}, {total_records_retrieved} of {total_records}")
-            all_data.extend(result['records'])  # Assuming 'data' contains the list of records
-            total_records = result.get('total', 1)  # Get total number of pages from the response
-            page_no += 1
-        else:
-            break
+    # convert the start time once rather than for every page
+    start_time_ms = to_timestamp_ms(start_time) if start_time else None
 
+    # the first page gives the total number of records, after which the remaining pages can be fetched concurrently
+    print("Retrieving page 1 of scale data history")
+    result = get_scale_data_history(device_id, 1, page_size, start_time_ms)
+    if not result:
+        return None
+    all_data = list(result['records'])
+    total_records = result.get('total', len(all_data))
+    print(f"Retrieved {len(all_data)} new records from page 1, {len(all_data)} of {total_records}")
+
+    # the server may return fewer records per page than requested, so derive the page count from page 1
+    num_pages = math.ceil(total_records / len(all_data)) if all_data else 1
+    if num_pages > 1:
+        print(f"Retrieving pages 2 to {num_pages} of scale data history")
+        with ThreadPoolExecutor(max_workers=min(HISTORY_WORKERS, num_pages - 1)) as executor:
+            results = executor.map(lambda page_no: get_scale_data_history(device_id, page_no, page_size, start_time_ms),
+                                   range(2, num_pages + 1))
+            for page_no, result in enumerate(results, start=2):
+                if not result:
+                    break
+                all_data.extend(result['records'])
+                print(f"Retrieved {len(result['records'])} new records from page {page_no}, {len(all_data)} of {total_records}")
+
+    # the order of records across pages is not guaranteed, so a partial result could leave a gap behind
+    # the resume point; report it as a failure so nothing is saved and the next run fetches it all again
+    if len(all_data) < total_records:
+        logging.error(f"Only retrieved {len(all_data)} of {total_records} scale history records")
+        return None
     return all_data
 
 # https://support.tuya.com/en/help/_detail/K9g77yt8rx4ii
 # retrieve a scale analysis report
 def get_analysis_report(device_id, data):
     #data = convert_scale_record(data)
-    response = openapi.post(path=f"/v1.0/scales/{device_id}/analysis-reports/", body=data, params=data)#, body=None)
+    response = call_api(openapi.post, path=f"/v1.0/scales/{device_id}/analysis-reports/", body=data, params=data)#, body=None)
     if response.get('success'):
         return response['result']
     else:
         logging.error(f"Failed to get analysis report for data ID {data}: {response}")
         return None
 
-# helper to determine age at a given time (in ms since Unix epoch) based on birthd date
-def age_at_time(time, birth_date):
-    # parse birth date 
-    birth_date = datetime.strptime(birth_date, "%Y-%m-%d")
-    record_date = datetime.fromtimestamp(time / 1000)
+# the analysis report is determined entirely by its inputs, so they identify a report
+def analysis_report_key(data):
+    return (data["height"], data["weight"], data["resistance"], data["age"], data["sex"])
+
+# retrieve the analysis report for each record that does not have one yet
+def enrich_with_analysis_reports(device_id, records):
+    # reports retrieved in earlier runs are reused for measurements with identical inputs
+    report_cache = {}
+    todo = []
+    for record in records:
+        if record.get('analysis_report'):
+            report_cache[analysis_report_key(convert_scale_record(record))] = record['analysis_report']
+        elif 'analysis_report' not in record:
+            todo.append(record)
+
+    # group the remaining records so each distinct set of inputs is only requested once
+    pending = {}
+    for record in todo:
+        data = convert_scale_record(record)
+        key = analysis_report_key(data)
+        if key in report_cache:
+            record['analysis_report'] = report_cache[key]
+        else:
+            pending.setdefault(key, (data, []))[1].append(record)
+
+    # reports are independent of each other, so request them concurrently
+    with ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS) as executor:
+        futures = {}
+        for data, pending_records in pending.values():
+            print(data)
+            futures[executor.submit(get_analysis_report, device_id, data)] = pending_records
+        for future in as_completed(futures):
+            for record in futures[future]:
+                record['analysis_report'] = future.result()
+
+# helper to determine age at a given time (in ms since Unix epoch) based on a parsed birth date
+def age_at_time(time_ms, birth_date):
+    return age_on_date(date.fromtimestamp(time_ms / 1000), birth_date)
+
+# records taken on the same day share the same age, so cache the result per date
+@lru_cache(maxsize=None)
+def age_on_date(record_date, birth_date):
     # Calculate the difference in years
     age = record_date.year - birth_date.year - ((record_date.month, record_date.day) < (birth_date.month, birth_date.day))
     return age
@@ -106,16 +283,17 @@ def convert_scale_record(data):
         "height": data["height"],
         "weight": data["wegith"],
         "resistance": data["body_r"],
-        "age": age_at_time(data["create_time"], BIRTHDATE),
+        "age": age_at_time(data["create_time"], BIRTH_DATE),
         "sex": 1 
     }
-    print(new_data)
     return new_data
 
 def load_existing_data(file_path):
     if os.path.exists(file_path):
         print(f"Loading existing data from {file_path}")
-        with open(file_path, 'r') as file:
+        with open(file_path, 'rb') as file:
+            if orjson:
+                return orjson.loads(file.read())
             return json.load(file)
     else:
         print(f"No existing data found at {file_path}")
@@ -123,34 +301,43 @@ def load_existing_data(file_path):
 
 def save_data(file_path, data):
     print(f"Saving data to {file_path}")
-    with open(file_path, 'w') as file:
-        json.dump(data, file, indent=4)
+    # orjson only supports 2-space indentation and writes raw UTF-8, match both with stdlib json
+    if orjson:
+        data_bytes = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    else:
+        data_bytes = json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+    atomic_write(file_path, data_bytes)
 
+# data is saved sorted by create_time, so the last record is the most recent
 def get_last_record_time(data):
     if data:
-        last_record = max(data, key=lambda x: x['create_time'])   
-        return datetime.fromtimestamp(last_record['create_time'] / 1000, tz=pytz.UTC)
+        last_record = data[-1]
+        return datetime.fromtimestamp(last_record['create_time'] / 1000, tz=timezone.utc)
     return None
 
 def update_data():
+    connect()
     existing_data = load_existing_data(DATA_FILE)
     last_record_time = get_last_record_time(existing_data)
     # add 1 ms to last record time to avoid retrieving the same records
     if last_record_time:
         last_record_time += timedelta(milliseconds=1)
     
-    new_data = get_all_scale_data_history(DEVICE_ID, start_time=last_record_time, page_size=100)
+    new_data = get_all_scale_data_history(DEVICE_ID, start_time=last_record_time, page_size=PAGE_SIZE)
+    if new_data is None:
+        logging.error("Failed to retrieve scale data history, existing data left unchanged")
+        return
+    # drop any records already stored, in case the API returns overlapping results
+    seen_ids = {record['id'] for record in existing_data}
+    new_data = [record for record in new_data if record['id'] not in seen_ids]
     
     if new_data:
-        all_data = existing_data + new_data
-        all_data = sorted(all_data, key=lambda x: x['create_time'])  # Ensure data is sorted by timestamp
-
-        # get the analysis report for the data
-        for record in all_data:
-            if 'analysis_report' in record:
-                continue
-            analysis_report = get_analysis_report(DEVICE_ID, convert_scale_record(record))
-            record['analysis_report'] = analysis_report
+        # existing data is already sorted, so only sort the new records and merge them in
+        record_time = itemgetter('create_time')
+        new_data.sort(key=record_time)
+        all_data = list(heapq.merge(existing_data, new_data, key=record_time))
+
+        enrich_with_analysis_reports(DEVICE_ID, all_data)
         
         save_data(DATA_FILE, all_data)
         print(f"New records retrieved: {len(new_data)}")
@@ -158,4 +345,7 @@ def update_data():
         print("No new records retrieved.")
 
 if __name__ == '__main__':
-    update_data()
+    try:
+        update_data()
+    finally:
+        openapi.session.close()